@@ -1,53 +1,109 @@
-from flask import Flask, render_template, redirect, url_for, flash, abort
+from flask import Flask, render_template, redirect, url_for, flash, abort,\
+      request, make_response
 from flask_bootstrap import Bootstrap
 from flask_ckeditor import CKEditor
-from datetime import date
-from werkzeug.security import generate_password_hash, check_password_hash
+from flask_caching import Cache
+from redis.exceptions import RedisError
+from datetime import date, datetime, timedelta
+from jinja2 import FileSystemBytecodeCache
+from werkzeug.security import check_password_hash
+from argon2 import PasswordHasher
+from argon2.exceptions import VerificationError, InvalidHashError
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy.orm import relationship
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import relationship, joinedload, selectinload
 from flask_login import UserMixin, login_user, LoginManager,\
       login_required, current_user, logout_user
 from forms import CreatePostForm, RegisterForm, LoginForm, CommentForm
-from flask_gravatar import Gravatar
 from functools import wraps
+import click
+import hashlib
+import time
 import os
 
-CURRENT_YEAR_FOR_FOOTER = date.today().strftime("%Y")
+POSTS_PER_PAGE = 20
+POSTS_VERSION_KEY = "posts_version"
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.getenv("FLASK_SECRET_KEY")
+# Static files are not fingerprinted, so keep their TTL modest; Flask still
+# answers revalidations with 304 once it expires.
+app.config['SEND_FILE_MAX_AGE_DEFAULT'] = timedelta(days=7)
+
+# Reuse compiled templates across workers and cold starts. Templates are only
+# re-checked on disk in debug mode (Flask's default for jinja auto_reload).
+app.jinja_env.cache_size = 400
+app.jinja_env.bytecode_cache = FileSystemBytecodeCache()
 
 # EXTENSIONS FLASK
 Bootstrap(app)
 ckeditor = CKEditor(app)
 login_manager = LoginManager(app)
-gravatar = Gravatar(app,
-                    size=500,
-                    rating='g',
-                    default='retro',
-                    force_default=False,
-                    use_ssl=False,
-                    base_url=None)
+
+# GRAVATAR: the URL is assembled in templates from each user's stored email hash
+app.jinja_env.globals.update(
+    gravatar_url_prefix="https://www.gravatar.com/avatar/",
+    gravatar_url_query="?s=500&d=retro&r=g",
+)
+
+# VIEW CACHE: Redis when REDIS_URL is set, otherwise caching is disabled
+app.config['CACHE_TYPE'] = 'RedisCache' if os.getenv("REDIS_URL") else 'NullCache'
+app.config['CACHE_REDIS_URL'] = os.getenv("REDIS_URL")
+app.config['CACHE_DEFAULT_TIMEOUT'] = 3600
+cache = Cache(app)
 
 ##CONNECT TO DB
 app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv("POSTGRES_MY_URL")
 
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# Split Postgres's connections evenly between workers so that
+# WEB_CONCURRENCY * (pool_size + max_overflow) stays under max_connections
+# (100 by default; 90 leaves room for admin sessions).
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE",
+                             int(os.getenv("DB_MAX_CONNECTIONS", 90)) // int(os.getenv("WEB_CONCURRENCY", 4))))
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    'pool_size': DB_POOL_SIZE,
+    'max_overflow': int(os.getenv("DB_MAX_OVERFLOW", 0)),
+    'pool_pre_ping': True,  # drop connections closed by Postgres idle timeouts
+    'pool_recycle': 300,
+    'query_cache_size': 1200,
+    # route executemany INSERT/UPDATE through psycopg2's fast execution helpers
+    'executemany_mode': 'values_plus_batch',
+    'insertmanyvalues_page_size': 1000,
+}
+
+# Objects are not reused across requests, so skip the refresh SELECT that
+# expiring them on commit would trigger (e.g. login_user after register).
+db = SQLAlchemy(app, session_options={'expire_on_commit': False})
+
+##PASSWORD HASHING (Argon2id)
+password_hasher = PasswordHasher(time_cost=2, memory_cost=65536, parallelism=2)
+
+@app.context_processor
+def inject_current_year():
+    """ Footer year, computed per render so it rolls over without a redeploy """
+    return {'current_year': date.today().year}
 
-db = SQLAlchemy(app)
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.filter_by(id = user_id).first()
+    return db.session.get(User, int(user_id))
 
 
 ##CONFIGURE TABLES
+def gravatar_hash_of_email(context):
+    """ Column default: the Gravatar hash of the email being inserted """
+    email = context.get_current_parameters()['email']
+    return hashlib.md5(email.strip().lower().encode()).hexdigest()
+
+
 class User(UserMixin, db.Model):
     __tablename__ = 'users'
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(250), nullable=False)
-    email = db.Column(db.String(250), nullable=False)
+    email = db.Column(db.String(250), nullable=False, unique=True, index=True)
     password = db.Column(db.String(250), nullable=False)
+    gravatar_hash = db.Column(db.String(32), nullable=False, default=gravatar_hash_of_email)
 
     posts = relationship('BlogPost', back_populates='author')
     comments = relationship('Comment', back_populates='comment_author')
@@ -62,9 +118,10 @@ class BlogPost(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(250), nullable=False)
     subtitle = db.Column(db.String(250), nullable=False)
-    date = db.Column(db.String(250), nullable=False)
+    date = db.Column(db.Date, nullable=False, default=date.today, index=True)
     body = db.Column(db.Text, nullable=False)
     img_url = db.Column(db.String(250), nullable=False)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow)
 
     author = relationship('User', back_populates='posts')
     comments = relationship('Comment', back_populates='parent_post')
@@ -83,22 +140,89 @@ class Comment(db.Model):
     comment_author = relationship('User', back_populates='comments')
     parent_post = relationship('BlogPost', back_populates='comments')
     
-    post_id = db.Column(db.Integer, db.ForeignKey('blog_posts.id'))
+    post_id = db.Column(db.Integer, db.ForeignKey('blog_posts.id'), index=True)
     author_id = db.Column(db.Integer, db.ForeignKey('users.id'))
 
     def __repr__(self):
         return f"Comment Author: {self.comment_author.name}"
 
 
+# PREBUILT STATEMENTS FOR HOT QUERIES
+USER_BY_EMAIL = db.select(User).where(User.email == db.bindparam('email'))
+
+
 # CREATE ALL TABLES IN THE DATABASE
-with app.app_context():
-    db.create_all()  
+@app.cli.command('init-db')
+def init_db():
+    """ Create the database tables, run once at deploy time """
+    db.create_all()
+    click.echo("Database tables created.")
+
+
+def verify_password(user, password):
+    """ Check a user's password, upgrading legacy PBKDF2 hashes to Argon2id """
+    # Legacy hashes; werkzeug verifies them with hashlib.pbkdf2_hmac (OpenSSL)
+    if user.password.startswith('pbkdf2:'):
+        if not check_password_hash(pwhash=user.password, password=password):
+            return False
+    else:
+        try:
+            password_hasher.verify(user.password, password)
+        except (VerificationError, InvalidHashError):
+            return False
+        if not password_hasher.check_needs_rehash(user.password):
+            return True
+
+    user.password = password_hasher.hash(password)
+    db.session.commit()
+    return True
+
+
+def make_etag(*parts):
+    """ Build an ETag from everything a rendered page depends on """
+    return hashlib.md5(repr(parts).encode()).hexdigest()
+
+
+def cacheable(response, etag):
+    """ Tag a per-user page so the browser revalidates it with If-None-Match """
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
+def cache_call(method, *args, **kwargs):
+    """ Call a cache method, treating an unreachable Redis as a cache miss """
+    try:
+        return method(*args, **kwargs)
+    except RedisError as error:
+        app.logger.warning("Cache unavailable: %s", error)
+        return None
+
+
+def posts_version():
+    """ Version of the post listing, or None when the cache is off or unreachable """
+    version = cache_call(cache.get, POSTS_VERSION_KEY)
+    if version is None:
+        # First use or evicted: seed from the clock so stale page keys aren't reused
+        cache_call(cache.add, POSTS_VERSION_KEY, int(time.time()), timeout=0)
+        version = cache_call(cache.get, POSTS_VERSION_KEY)
+    return version
+
+
+def bump_posts_version():
+    """ Invalidate cached home pages after a post is created, edited or deleted """
+    # Seed first, otherwise incrementing a missing key restarts the version at 1
+    if posts_version() is not None:
+        # Flask-Caching has no inc(); the backend's is an atomic INCR on Redis
+        cache_call(cache.cache.inc, POSTS_VERSION_KEY)
 
 
 def admin_only(func):
     @wraps(func)
     def inner_fuction(*args, **kwargs):
-        if current_user.id != 1:
+        # Also safe if applied without login_required: anonymous users get a 403
+        if not current_user.is_authenticated or current_user.get_id() != '1':
             return abort(code=403)
         
         return func(*args, **kwargs)
@@ -106,12 +230,58 @@ def admin_only(func):
     return inner_fuction
 
 
+def posts_page_query(before_id, *columns):
+    """ One home page of posts, plus one row to tell whether an older page exists """
+    # Keyset pagination: seek past the last id shown instead of using OFFSET
+    query = db.select(*columns)
+    if before_id is not None:
+        query = query.where(BlogPost.id < before_id)
+    return query.order_by(BlogPost.id.desc()).limit(POSTS_PER_PAGE + 1)
+
+
+def render_posts_page(before_id):
+    """ Render one page of the home page listing """
+    posts = db.session.execute(
+        posts_page_query(before_id, BlogPost).options(joinedload(BlogPost.author))
+    ).scalars().unique().all()
+
+    older_posts_id = None
+    if len(posts) > POSTS_PER_PAGE:
+        posts = posts[:POSTS_PER_PAGE]
+        older_posts_id = posts[-1].id
+
+    return render_template("index.html", all_posts=posts, older_posts_id=older_posts_id)
+
+
 @app.route('/')
 def get_all_posts():
-    """ Show all blog posts in home page """
-    posts = BlogPost.query.all()
-
-    return render_template("index.html", all_posts=posts, current_year=CURRENT_YEAR_FOR_FOOTER)
+    """ Show blog posts in home page, newest first, one page at a time """
+    before_id = request.args.get('before_id', type=int)
+    version = posts_version()
+    use_cache = version is not None
+    if not use_cache:
+        # Without Redis, validate against the rows this page shows (an index scan
+        # of one page): edits, new posts and deletions on the page all change them
+        version = tuple(db.session.execute(
+            posts_page_query(before_id, BlogPost.id, BlogPost.updated_at)
+        ).all())
+
+    etag = make_etag(version, before_id, current_user.get_id(), date.today().year)
+    if request.if_none_match.contains(etag):
+        return cacheable(make_response("", 304), etag)
+
+    if current_user.is_authenticated or not use_cache:
+        html = render_posts_page(before_id)
+    else:
+        # Every anonymous visitor sees the same page, so a hit costs two Redis GETs
+        html = cache_call(cache.get, f"index:{etag}")
+        if html is None:
+            html = render_posts_page(before_id)
+            # before_id comes from the client: only cache pages that start at a real post
+            if before_id is None or db.session.get(BlogPost, before_id):
+                cache_call(cache.set, f"index:{etag}", html)
+
+    return cacheable(make_response(html), etag)
 
 
 @app.route('/register', methods=['GET', 'POST'])
@@ -119,11 +289,7 @@ def register():
     """ Responsible for registering new users """
     register_form = RegisterForm()
     if register_form.validate_on_submit():
-        hash_and_salted_password = generate_password_hash(register_form.password.data, method='pbkdf2', salt_length=8)
-        
-        if User.query.filter_by(email = register_form.email.data).first():
-            flash(message="You've already signed up with that email, log in instead!")
-            return redirect(url_for('login'))
+        hash_and_salted_password = password_hasher.hash(register_form.password.data)
             
         new_user = User(
             name = register_form.name.data,
@@ -131,13 +297,19 @@ def register():
             password = hash_and_salted_password,
         )
 
+        # The unique index on users.email catches duplicates, even concurrent ones
         db.session.add(new_user)
-        db.session.commit()
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            flash(message="You've already signed up with that email, log in instead!")
+            return redirect(url_for('login'))
 
         login_user(new_user)
         return redirect(url_for('get_all_posts'))
     
-    return render_template("register.html", form=register_form, current_year=CURRENT_YEAR_FOR_FOOTER)
+    return render_template("register.html", form=register_form)
 
 
 @app.route('/login', methods=['GET', 'POST'])
@@ -145,9 +317,9 @@ def login():
     """ Responsible for user login """
     login_form = LoginForm()
     if login_form.validate_on_submit():
-        user = User.query.filter_by(email = login_form.email.data).first()
+        user = db.session.execute(USER_BY_EMAIL, {'email': login_form.email.data}).scalar_one_or_none()
         if user:
-            if check_password_hash(pwhash=user.password, password=login_form.password.data):
+            if verify_password(user, login_form.password.data):
                 login_user(user)
                 return redirect(url_for('get_all_posts'))
             else: 
@@ -157,7 +329,7 @@ def login():
         
         return redirect(url_for('login'))
             
-    return render_template("login.html", form=login_form, current_year=CURRENT_YEAR_FOR_FOOTER)
+    return render_template("login.html", form=login_form)
 
 
 @app.route('/logout')
@@ -170,8 +342,6 @@ def logout():
 @app.route("/post/<int:post_id>", methods=['GET', 'POST'])
 def show_post(post_id):
     """ Responsible for showing all database publications """
-    requested_post = BlogPost.query.filter_by(id = post_id).first()
-    all_comments_of_post = Comment.query.all()
     form = CommentForm()
     if form.validate_on_submit():
         if not current_user.is_authenticated:
@@ -181,13 +351,41 @@ def show_post(post_id):
         new_comment = Comment(
             text=form.comment_text.data,
             comment_author=current_user,
-            parent_post=requested_post
+            post_id=post_id
             )
         
         db.session.add(new_comment)
-        db.session.commit()
-
-    return render_template("post.html", post=requested_post, form=form, all_comments=all_comments_of_post, current_year=CURRENT_YEAR_FOR_FOOTER)
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # post_id is not checked up front; the foreign key rejects unknown posts
+            db.session.rollback()
+            return abort(code=404)
+
+        # Redirect-after-POST: a refresh can't resubmit the comment
+        return redirect(url_for('show_post', post_id=post_id))
+
+    post_version = db.session.execute(
+        db.select(BlogPost.updated_at, db.func.count(Comment.id), db.func.max(Comment.id))
+        .outerjoin(BlogPost.comments)
+        .where(BlogPost.id == post_id)
+        .group_by(BlogPost.id)
+    ).one_or_none()
+    if post_version is None:
+        return abort(code=404)
+    # The page embeds a CSRF token, so let a cached copy expire well before the token does
+    csrf_window = int(time.time()) // ((app.config.get('WTF_CSRF_TIME_LIMIT') or 3600) // 2)
+    etag = make_etag(post_id, tuple(post_version), current_user.get_id(), csrf_window, date.today().year)
+    if request.if_none_match.contains(etag):
+        return cacheable(make_response("", 304), etag)
+
+    requested_post = db.session.get(BlogPost, post_id, options=[
+        joinedload(BlogPost.author),
+        selectinload(BlogPost.comments).selectinload(Comment.comment_author),
+    ])
+
+    response = make_response(render_template("post.html", post=requested_post, form=form, all_comments=requested_post.comments))
+    return cacheable(response, etag)
 
 
 @app.route("/new-post", methods=['GET', 'POST'])
@@ -203,14 +401,14 @@ def add_new_post():
             body=form.body.data,
             img_url=form.img_url.data,
             author=current_user,
-            date=date.today().strftime("%B %d, %Y"),
         )
         db.session.add(new_post)
         db.session.commit()
+        bump_posts_version()
         
         return redirect(url_for("get_all_posts"))
     
-    return render_template("make-post.html", form=form, current_year=CURRENT_YEAR_FOR_FOOTER)
+    return render_template("make-post.html", form=form)
 
 
 @app.route("/edit-post/<int:post_id>", methods=['GET', 'POST'])
@@ -218,12 +416,11 @@ def add_new_post():
 @admin_only
 def edit_post(post_id):
     """ Responsible for database publication editing """
-    post = BlogPost.query.get(post_id)
+    post = db.get_or_404(BlogPost, post_id)
     edit_form = CreatePostForm(
         title=post.title,
         subtitle=post.subtitle,
         img_url=post.img_url,
-        author=post.author,
         body=post.body
     )
     if edit_form.validate_on_submit():
@@ -233,8 +430,9 @@ def edit_post(post_id):
         post.author = current_user
         post.body = edit_form.body.data
         db.session.commit()
+        bump_posts_version()
 
-        return redirect(url_for("show_post", post_id=post.id, current_year=CURRENT_YEAR_FOR_FOOTER))
+        return redirect(url_for("show_post", post_id=post.id))
 
     return render_template("make-post.html", form=edit_form)
 
@@ -244,21 +442,22 @@ def edit_post(post_id):
 @admin_only
 def delete_post(post_id):
     """ Responsible for deleting a publication from the database """
-    post_to_delete = BlogPost.query.get(post_id)
+    post_to_delete = db.get_or_404(BlogPost, post_id)
     db.session.delete(post_to_delete)
     db.session.commit()
+    bump_posts_version()
 
     return redirect(url_for('get_all_posts'))
 
 
 @app.route("/about")
 def about():
-    return render_template("about.html", current_year=CURRENT_YEAR_FOR_FOOTER)
+    return render_template("about.html")
 
 
 @app.route("/contact", methods=['GET', 'POST'])
 def contact():
-    return render_template("contact.html", current_year=CURRENT_YEAR_FOR_FOOTER)
+    return render_template("contact.html")
 
 
 if __name__ == "__main__":
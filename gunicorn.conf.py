@@ -0,0 +1,20 @@
+# Gunicorn settings for serving the blog outside Vercel:
+#   pip install gunicorn gevent psycogreen
+#   gunicorn api.main:app
+import os
+
+bind = os.getenv("BIND", "0.0.0.0:8000")
+# Each worker opens up to DB_POOL_SIZE + DB_MAX_OVERFLOW Postgres connections
+# (see api/main.py); by default the pool is DB_MAX_CONNECTIONS // workers, so
+# raising workers shrinks each pool instead of exceeding max_connections.
+workers = int(os.getenv("WEB_CONCURRENCY", 4))
+worker_class = "gevent"
+# Greenlets in a worker share its DB pool; keep this a small multiple of the
+# pool size so requests don't queue past pool_timeout waiting for a connection.
+worker_connections = int(os.getenv("WORKER_CONNECTIONS", 100))
+
+
+def post_fork(server, worker):
+    # Let psycopg2 yield to other greenlets while it waits on Postgres
+    from psycogreen.gevent import patch_psycopg
+    patch_psycopg()